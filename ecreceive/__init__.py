@@ -1,10 +1,9 @@
 import time
-import copy
+import random
 import logging
 import traceback
 import datetime
 import dateutil.tz
-import dateutil.relativedelta
 
 __package__ = "ecreceive"
 __version__ = "2.0.0"
@@ -25,25 +24,27 @@ def parse_filename_timestamp(stamp, now):
     Parse a timestamp from a ECMWF dataset filename.
     The year is not part of the filename, and must be guessed.
     Returns a datetime object, or None if only underscores are given.
+    Raises ValueError if the timestamp is not valid.
     """
     if stamp == "________":
         return None
-    stamp = "%d%s" % (now.year, stamp)
-    try:
-        ts = datetime.datetime.strptime(stamp, "%Y%m%d%H%M")
-    except ValueError:
-        ts = datetime.datetime.strptime(stamp, "%Y%m%d____")
-    ts = force_utc(ts)
+    date, time_of_day = stamp[:4], stamp[4:]
+    if time_of_day == "____":
+        time_of_day = "0000"
+    if len(stamp) != 8 or not (date + time_of_day).isdigit():
+        raise ValueError("Invalid timestamp: %s" % stamp)
+    month = int(date[:2])
+    ts = datetime.datetime(now.year, month, int(date[2:]), int(time_of_day[:2]), int(time_of_day[2:]),
+                           tzinfo=dateutil.tz.tzutc())
 
     # Check whether the dataset timestamp contains a different month than the
     # current month. If so, it may be set in a different year, which is not
     # specified in the timestamp. This is a workaround for that, assuring that
     # the correct year is used.
-    for delta in [-1, 1]:
-        ts_alternate = copy.copy(now)
-        ts_alternate += dateutil.relativedelta.relativedelta(months=delta)
-        if ts_alternate.month == ts.month:
-            ts = ts.replace(year=ts_alternate.year)
+    if now.month == 1 and month == 12:
+        ts = ts.replace(year=now.year - 1)
+    elif now.month == 12 and month == 1:
+        ts = ts.replace(year=now.year + 1)
     return ts
 
 
@@ -66,10 +67,12 @@ def run_with_exception_logging(func):
     return exit_code
 
 
-def retry_n(func, interval=5, exceptions=(Exception,), warning=1, error=3, give_up=5):
+def retry_n(func, interval=5, exceptions=(Exception,), warning=1, error=3, give_up=5, max_interval=60):
     """
     Call 'func' and, if it throws anything listed in 'exceptions', catch it and retry again
     up to 'give_up' times. If give_up is <= 0, retry indefinitely.
+    The delay between retries starts at 'interval' seconds and doubles for each
+    failure, up to 'max_interval' seconds, with a small random jitter added.
     Checks that error > warning > 0, and give_up > error or give_up <= 0.
     """
     assert (warning > 0) and (error > warning) and (give_up <= 0 or give_up > error)
@@ -88,5 +91,6 @@ def retry_n(func, interval=5, exceptions=(Exception,), warning=1, error=3, give_
                 logfunc = logging.warning
             else:
                 logfunc = logging.info
-            logfunc("Action failed, retrying in %d seconds: %s" % (interval, e))
-            time.sleep(interval)
+            delay = min(interval * 2 ** (tries - 1), max_interval) + random.uniform(0, interval * 0.1)
+            logfunc("Action failed, retrying in %.1f seconds: %s" % (delay, e))
+            time.sleep(delay)
@@ -1,5 +1,8 @@
-import logging
+import os
 import json
+import logging
+import sqlite3
+import contextlib
 
 
 CHECKPOINT_DATASET_NOFLAGS = 0
@@ -7,72 +10,156 @@ CHECKPOINT_DATASET_EXISTS = 1
 CHECKPOINT_DATASET_MOVED = 2
 CHECKPOINT_DATASET_LOCKED = 4
 
+# The first bytes of every SQLite database file
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, flags INTEGER NOT NULL)'
+
 
 class Checkpoint(object):
     """
-    This class creates a state file, which keeps a key/value store of Datasets
-    and their states.
+    This class creates a state database, which keeps a key/value store of
+    Datasets and their states. Each key is stored in its own row, so that
+    changing the state of a single Dataset does not rewrite the entire state.
+
+    State files written in JSON format by earlier versions are converted into
+    a database when loaded.
     """
     def __init__(self, path):
-        self._states = {}
         self._path = path
+        self._db = None
+        self._in_batch = False
         self.load()
 
-    def save(self):
-        data = json.dumps(self._states, sort_keys=True, indent=4, separators=(',', ': '))
-        data = data.encode('ascii')
+    @contextlib.contextmanager
+    def _write(self):
+        """
+        Run the statements in the block in a single transaction, unless they
+        are part of a batch.
+        """
+        if self._in_batch:
+            yield
+            return
         try:
-            with open(self._path, 'wb') as f:
-                f.write(data)
-        except IOError:
-            logging.error('State file %s cannot be written' % self._path)
-            raise
+            with self._db:
+                yield
+        except sqlite3.Error as e:
+            logging.error('State file %s cannot be written: %s' % (self._path, e))
+            raise IOError(str(e))
 
-    def load(self):
-        self._states = {}
+    def _read_legacy_states(self):
+        """
+        Return the states in a JSON state file, or None if the state file is
+        missing, empty, or already a database.
+        """
         try:
             with open(self._path, 'rb') as f:
-                data = f.read()
-            if data:
-                self._states = json.loads(data.decode('ascii'))
+                header = f.read(len(SQLITE_HEADER))
+                if not header or header == SQLITE_HEADER:
+                    return None
+                data = header + f.read()
         except IOError:
             logging.info('State file %s does not exist, starting from scratch' % self._path)
+            return None
+        return json.loads(data.decode('ascii'))
 
-    def keys(self):
-        return [x for x in self._states.keys()]
+    def _convert_legacy_states(self, states):
+        """
+        Replace the JSON state file with a database containing the same
+        states. The database is written to a temporary file and renamed into
+        place, so that a crash never leaves a truncated state file behind.
+        """
+        logging.info('Converting JSON state file %s into a database' % self._path)
+        tmp_path = self._path + '.tmp'
+        try:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            db = sqlite3.connect(tmp_path)
+            try:
+                with db:
+                    db.execute(SCHEMA)
+                    db.executemany('INSERT INTO states (key, flags) VALUES (?, ?)', states.items())
+            finally:
+                db.close()
+            os.replace(tmp_path, self._path)
+        except sqlite3.Error as e:
+            logging.error('State file %s cannot be converted: %s' % (self._path, e))
+            raise IOError(str(e))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Run all operations in the block in a single transaction, committing
+        them together at the end of the block.
+        """
+        with self._write():
+            self._in_batch = True
+            try:
+                yield
+            finally:
+                self._in_batch = False
+
+    def load(self):
+        legacy_states = self._read_legacy_states()
+        if legacy_states is not None:
+            self._convert_legacy_states(legacy_states)
+        try:
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error as e:
+            logging.error('State file %s cannot be opened: %s' % (self._path, e))
+            raise IOError(str(e))
+        with self._write():
+            self._db.execute(SCHEMA)
+
+    def keys(self, after='', limit=-1):
+        """
+        Return the keys in sorted order. Only keys sorting after 'after' are
+        returned, at most 'limit' of them if it is not negative. Pass the last
+        key of one page as 'after' to get the next; unlike an offset, this
+        does not skip keys when earlier keys are deleted in the meantime.
+        """
+        cursor = self._db.execute('SELECT key FROM states WHERE key > ? ORDER BY key LIMIT ?', (after, limit))
+        return [row[0] for row in cursor]
 
     def get(self, key):
-        if key not in self._states:
+        row = self._db.execute('SELECT flags FROM states WHERE key = ?', (key,)).fetchone()
+        if row is None:
             return 0
-        return self._states[key]
+        return row[0]
 
     def add(self, key, state):
-        if key not in self._states:
-            self._states[key] = CHECKPOINT_DATASET_NOFLAGS
-        self._states[key] |= state
-        self.save()
+        with self._write():
+            self._db.execute('INSERT OR IGNORE INTO states (key, flags) VALUES (?, ?)',
+                             (key, CHECKPOINT_DATASET_NOFLAGS))
+            self._db.execute('UPDATE states SET flags = (flags | ?) WHERE key = ?', (state, key))
 
     def subtract(self, key, state):
-        if key not in self._states:
-            self._states[key] = CHECKPOINT_DATASET_NOFLAGS
-        self._states[key] &= ~state
-        self.save()
+        with self._write():
+            self._db.execute('INSERT OR IGNORE INTO states (key, flags) VALUES (?, ?)',
+                             (key, CHECKPOINT_DATASET_NOFLAGS))
+            self._db.execute('UPDATE states SET flags = (flags & ~?) WHERE key = ?', (state, key))
 
-    def lock(self, key):
-        if self.get(key) & CHECKPOINT_DATASET_LOCKED:
-            return False
-        self.add(key, CHECKPOINT_DATASET_LOCKED)
-        return True
+    def lock(self, key, state=CHECKPOINT_DATASET_NOFLAGS):
+        """
+        Lock a key, and add 'state' to its flags if the lock was obtained.
+        Returns False if the key was already locked.
+        """
+        with self._write():
+            self._db.execute('INSERT OR IGNORE INTO states (key, flags) VALUES (?, ?)',
+                             (key, CHECKPOINT_DATASET_NOFLAGS))
+            cursor = self._db.execute('UPDATE states SET flags = (flags | ?) WHERE key = ? AND (flags & ?) = 0',
+                                      (CHECKPOINT_DATASET_LOCKED | state, key, CHECKPOINT_DATASET_LOCKED))
+        return cursor.rowcount == 1
 
     def unlock(self, key):
         self.subtract(key, CHECKPOINT_DATASET_LOCKED)
 
     def unlock_all(self):
-        self.load()
-        for key in self._states.keys():
-            self.unlock(key)
+        with self._write():
+            self._db.execute('UPDATE states SET flags = (flags & ~?)', (CHECKPOINT_DATASET_LOCKED,))
 
     def delete(self, key):
-        if key in self._states:
-            del self._states[key]
-            self.save()
+        with self._write():
+            self._db.execute('DELETE FROM states WHERE key = ?', (key,))
@@ -1,14 +1,89 @@
 import os
+import re
+import hmac
+import shutil
+import binascii
 import hashlib
 import logging
 import datetime
 
 import ecreceive
+import ecreceive.checkpoint
 import ecreceive.exceptions
 
 import productstatus.exceptions
 
 
+# Copying an initialized hash object is cheaper than creating a new one.
+# The md5sum only guards against corrupted transfers, which lets OpenSSL use
+# MD5 even where it is disabled for security purposes.
+try:
+    MD5_TEMPLATE = hashlib.md5(usedforsecurity=False)
+except TypeError:
+    MD5_TEMPLATE = hashlib.md5()
+# How many bytes to read at a time when calculating md5sums.
+MD5_CHUNK_SIZE = 4 * 1024 * 1024
+# ECMWF dataset filename; see Dataset.parse_filename().
+FILENAME_PATTERN = re.compile(r'^(?P<name>.{2})(?P<stream_use>.)(?P<start>[0-9_]{8})(?P<end>[0-9_]{8})(?P<version>[0-9]+)$')
+
+
+def fadvise(fd, advice):
+    """
+    Tell the kernel how the entire file behind 'fd' is going to be accessed.
+    'advice' is the name of a POSIX_FADV_* constant in the os module. Does
+    nothing on platforms without posix_fadvise.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def same_filesystem(path, directory):
+    """
+    Returns True if 'path' and 'directory' are on the same file system.
+    """
+    return os.stat(path).st_dev == os.stat(directory).st_dev
+
+
+def fsync_directory(directory):
+    """
+    Flush changes to the entries of 'directory' to disk.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def stat_signature(st):
+    """
+    Return the parts of a stat result that identify a file and change when it
+    is rewritten.
+    """
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def md5_read(f):
+    """
+    Return an md5 hash object of the contents of the binary file 'f', by
+    reading it in chunks.
+    """
+    if hasattr(hashlib, 'file_digest'):
+        # Python 3.11+ runs the read loop inside hashlib.
+        return hashlib.file_digest(f, MD5_TEMPLATE.copy)
+    h = MD5_TEMPLATE.copy()
+    # Read into a single preallocated buffer; 'f' should be unbuffered, since
+    # we do our own chunking.
+    buf = bytearray(MD5_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(view[:n])
+    return h
+
+
 class Dataset(object):
     """
     The Dataset class represents a combination of a data file and its md5sum
@@ -18,34 +93,28 @@ class Dataset(object):
     def __init__(self, path):
         """
         Class constructor. Takes the full path to either the md5sum or the data
-        file itself, as a string.
-        """
-        paths = self._derive_paths(path)
-        self.data_path = paths['data']
-        self.md5_path = paths['md5']
-        self.md5_key = None
-        self.md5_result = None
-        self.filename_components = {}
-
-    def _derive_paths(self, path):
-        """
-        Given a path to either the data file itself or its md5sum counterpart,
-        figure out the paths for both of them.
+        file itself, as a string or path-like object.
         """
-        paths = {}
+        path = os.fspath(path)
         if self.is_md5_path(path):
-            paths['md5'] = path
-            paths['data'] = self.md5_to_data_path(path)
+            self.md5_path = path
+            self.data_path = path[:-4]
         else:
-            paths['md5'] = self.data_to_md5_path(path)
-            paths['data'] = path
-        return paths
+            self.md5_path = path + '.md5'
+            self.data_path = path
+        # Moving the dataset does not change its file names.
+        self._data_filename = os.path.basename(self.data_path)
+        self.md5_key = None
+        self.md5_key_digest = None
+        self.md5_result_digest = None
+        self.filename_components = {}
+        self.exists_cache = {}
 
     def is_md5_path(self, path):
         """
         Returns True if the specified path points to an md5sum file, False otherwise.
         """
-        return path[-4:] == '.md5'
+        return path.endswith('.md5')
 
     def data_to_md5_path(self, path):
         """
@@ -58,17 +127,32 @@ class Dataset(object):
             raise ecreceive.exceptions.ECReceiveException('Cannot derive a data path from a non-md5sum path')
         return path[:-4]
 
+    def exists(self, path):
+        """
+        Returns True if the specified path exists, False otherwise. The result
+        is cached until the dataset is moved, deleted or refreshed.
+        """
+        if path not in self.exists_cache:
+            self.exists_cache[path] = os.path.exists(path)
+        return self.exists_cache[path]
+
+    def refresh(self):
+        """
+        Forget which files were found to exist, and check again when asked.
+        """
+        self.exists_cache = {}
+
     def has_data_file(self):
         """
         Returns True if the specified md5sum file exists along with a data file, False otherwise.
         """
-        return os.path.exists(self.data_path)
+        return self.exists(self.data_path)
 
     def has_md5_file(self):
         """
         Returns True if the specified data file exists along with an md5sum file, False otherwise.
         """
-        return os.path.exists(self.md5_path)
+        return self.exists(self.md5_path)
 
     def complete(self):
         """
@@ -90,45 +174,92 @@ class Dataset(object):
             os.unlink(self.md5_path)
         else:
             logging.error("md5sum file does not exist: '%s'", self.md5_path)
+        self.refresh()
 
     def read_md5sum(self):
         """
-        Read the contents of the md5sum file into memory.
+        Read the contents of the md5sum file into memory. The file is only
+        read once.
         """
+        if self.md5_key_digest is not None:
+            return
         if not self.has_md5_file():
             raise ecreceive.exceptions.ECReceiveException('Cannot read md5sum without an md5sum file')
-        with open(self.md5_path, 'rb') as f:
-            self.md5_key = f.read(32).decode('ascii')
-            if len(self.md5_key) != 32:
-                raise ecreceive.exceptions.InvalidDataException('md5sum file is less than 32 bytes')
+        # The file is tiny; read it without setting up a buffered reader.
+        fd = os.open(self.md5_path, os.O_RDONLY)
+        try:
+            self.md5_key = os.read(fd, 32).decode('ascii')
+        finally:
+            os.close(fd)
+        if len(self.md5_key) != 32:
+            raise ecreceive.exceptions.InvalidDataException('md5sum file is less than 32 bytes')
+        try:
+            self.md5_key_digest = binascii.unhexlify(self.md5_key)
+        except binascii.Error:
+            raise ecreceive.exceptions.InvalidDataException('md5sum file does not contain a hexadecimal md5sum')
 
     def calculate_md5sum(self):
         """
         Calculate the md5sum of the data file.
         """
-        h = hashlib.md5()
         if not self.has_data_file():
             raise ecreceive.exceptions.ECReceiveException('Cannot calculate md5sum without a data file')
-        with open(self.data_path, 'rb') as f:
-            while True:
-                data = f.read(256*128)  # md5 block size is 128
-                if len(data) == 0:
-                    break
-                h.update(data)
-        self.md5_result = h.hexdigest()
+        with open(self.data_path, 'rb', buffering=0) as f:
+            st = os.fstat(f.fileno())
+            h = self._hash_data_file(f, st.st_size)
+        self.md5_result_digest = h.digest()
+
+    def _hash_data_file(self, f, size):
+        """
+        Return an md5 hash object of the contents of the open data file.
+        """
+        if not size:
+            # The hash of an empty file is the hash of no data at all.
+            return MD5_TEMPLATE.copy()
+        fadvise(f.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        # The file is read rather than memory mapped: spool files may be
+        # truncated by another process, which would crash the daemon with
+        # SIGBUS while hashing a mapping.
+        return md5_read(f)
+
+    def prefetch_data_file(self):
+        """
+        Ask the kernel to start reading the data file into the page cache, so
+        that the read overlaps with other work.
+        """
+        try:
+            fd = os.open(self.data_path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            fadvise(fd, 'POSIX_FADV_WILLNEED')
+        finally:
+            os.close(fd)
 
     def valid(self):
         """
-        Returns True if md5sum matches data file contents.
+        Returns True if md5sum matches data file contents. This is the
+        integrity check, so the data file is always hashed: a file rewritten
+        in place with the same size within the mtime granularity has an
+        unchanged stat signature.
         """
-        if not self.md5_key:
+        if self.md5_key_digest is None:
+            self.prefetch_data_file()
             self.read_md5sum()
-        if not self.md5_result:
-            self.calculate_md5sum()
-        return self.md5_key == self.md5_result
+        self.calculate_md5sum()
+        return hmac.compare_digest(self.md5_key_digest, self.md5_result_digest)
+
+    @property
+    def md5_result(self):
+        """
+        The calculated md5sum of the data file as a hexadecimal string, or None.
+        """
+        if self.md5_result_digest is None:
+            return None
+        return self.md5_result_digest.hex()
 
     def md5(self):
-        if not self.md5_result:
+        if not self.md5_result_digest:
             self.calculate_md5sum()
         return self.md5_result
 
@@ -136,7 +267,7 @@ class Dataset(object):
         """
         Return the filename part of the data file path.
         """
-        return os.path.basename(self.data_path)
+        return self._data_filename
 
     def move(self, destination):
         """
@@ -144,11 +275,22 @@ class Dataset(object):
         """
         if not self.complete():
             raise ecreceive.exceptions.ECReceiveException('Dataset must be complete before moving it')
-        for member in ['data_path', 'md5_path']:
-            path = getattr(self, member)
-            destination_path = os.path.join(destination, os.path.basename(path))
-            os.rename(path, destination_path)
-            setattr(self, member, destination_path)
+        # os.rename() fails across file systems, in which case the files
+        # must be copied.
+        if same_filesystem(self.data_path, destination):
+            rename = os.rename
+        else:
+            rename = shutil.move
+        # The md5sum file is moved last, since its presence signals that the
+        # data file is complete.
+        data_path = os.path.join(destination, self._data_filename)
+        md5_path = self.data_to_md5_path(data_path)
+        rename(self.data_path, data_path)
+        self.data_path = data_path
+        rename(self.md5_path, md5_path)
+        self.md5_path = md5_path
+        fsync_directory(destination)
+        self.refresh()
 
     def __repr__(self):
         """
@@ -160,11 +302,13 @@ class Dataset(object):
         """
         Return a textual representation of the dataset state.
         """
-        if self.complete():
+        has_data_file = self.has_data_file()
+        has_md5_file = self.has_md5_file()
+        if has_data_file and has_md5_file:
             return 'complete'
-        elif self.has_data_file() and not self.has_md5_file():
+        elif has_data_file:
             return 'missing md5sum'
-        elif self.has_md5_file() and not self.has_data_file():
+        elif has_md5_file:
             return 'missing data file'
         else:
             return 'missing'
@@ -187,53 +331,62 @@ class Dataset(object):
         """
         if self.filename_components:
             return
-        filename = self.data_filename()
-        start = filename[3:11]
-        end = filename[11:19]
+        match = FILENAME_PATTERN.match(self.data_filename())
+        if match is None:
+            raise ecreceive.exceptions.InvalidFilenameException('Filename %s does not match expected format' % self.data_filename())
+        # The pattern only checks the character classes; the timestamps may
+        # still hold impossible dates.
         try:
-            self.filename_components['analysis_start_time'] = ecreceive.parse_filename_timestamp(start, now)
-            self.filename_components['analysis_end_time'] = ecreceive.parse_filename_timestamp(end, now)
-            self.filename_components['name'] = filename[0:2]
-            self.filename_components['stream_use'] = filename[2]
-            self.filename_components['version'] = int(filename[19:])
+            analysis_start_time = ecreceive.parse_filename_timestamp(match.group('start'), now)
+            analysis_end_time = ecreceive.parse_filename_timestamp(match.group('end'), now)
         except ValueError:
-            self.filename_components = {}
             raise ecreceive.exceptions.InvalidFilenameException('Filename %s does not match expected format' % self.data_filename())
+        self.filename_components = {
+            'analysis_start_time': analysis_start_time,
+            'analysis_end_time': analysis_end_time,
+            'name': match.group('name'),
+            'stream_use': match.group('stream_use'),
+            'version': int(match.group('version')),
+        }
+
+    def filename_component(self, key):
+        """
+        Return a single parsed component of the dataset filename. The filename
+        is only parsed the first time a component is requested.
+        """
+        if not self.filename_components:
+            self.parse_filename(datetime.datetime.now())
+        return self.filename_components[key]
 
     def analysis_start_time(self):
         """
         Return the analysis start time of this dataset, according to the filename.
         """
-        self.parse_filename(datetime.datetime.now())
-        return self.filename_components['analysis_start_time']
+        return self.filename_component('analysis_start_time')
 
     def analysis_end_time(self):
         """
         Return the analysis end time of this dataset, according to the filename.
         """
-        self.parse_filename(datetime.datetime.now())
-        return self.filename_components['analysis_end_time']
+        return self.filename_component('analysis_end_time')
 
     def name(self):
         """
         Return the dataset name, according to the filename.
         """
-        self.parse_filename(datetime.datetime.now())
-        return self.filename_components['name']
+        return self.filename_component('name')
 
     def stream_use(self):
         """
         Return the dataset name, according to the filename.
         """
-        self.parse_filename(datetime.datetime.now())
-        return self.filename_components['stream_use']
+        return self.filename_component('stream_use')
 
     def version(self):
         """
         Return the dataset version, according to the filename.
         """
-        self.parse_filename(datetime.datetime.now())
-        return self.filename_components['version']
+        return self.filename_component('version')
 
     def file_type(self):
         """
@@ -273,6 +426,12 @@ class DatasetPublisher(object):
         self.productstatus = productstatus_api
         self.productstatus_service_backend_key = productstatus_service_backend_key
         self.productstatus_source_key = productstatus_source_key
+        # Productstatus resources which do not change while we are running,
+        # looked up the first time they are needed.
+        self.productstatus_dataformats = {}
+        self.productstatus_products = {}
+        self.productstatus_institution = None
+        self.productstatus_servicebackend = None
 
     def get_dataset_key(self, dataset):
         return dataset.data_filename()
@@ -281,8 +440,8 @@ class DatasetPublisher(object):
         """
         Remote procedure call to the checkpoint thread.
         """
-        self.checkpoint_socket.send_json(args)
-        return self.checkpoint_socket.recv_json()
+        self.checkpoint_socket.send_pyobj(args)
+        return self.checkpoint_socket.recv_pyobj()
 
     def checkpoint_add(self, dataset, flag):
         return self.checkpoint_zeromq_rpc('add', self.get_dataset_key(dataset), flag)
@@ -293,8 +452,8 @@ class DatasetPublisher(object):
     def checkpoint_delete(self, dataset):
         return self.checkpoint_zeromq_rpc('delete', self.get_dataset_key(dataset))
 
-    def checkpoint_lock(self, dataset):
-        return self.checkpoint_zeromq_rpc('lock', self.get_dataset_key(dataset))
+    def checkpoint_lock(self, dataset, flag=ecreceive.checkpoint.CHECKPOINT_DATASET_NOFLAGS):
+        return self.checkpoint_zeromq_rpc('lock', self.get_dataset_key(dataset), flag)
 
     def checkpoint_unlock(self, dataset):
         return self.checkpoint_zeromq_rpc('unlock', self.get_dataset_key(dataset))
@@ -305,24 +464,45 @@ class DatasetPublisher(object):
         correct data format.
         """
         file_type = dataset.file_type()
+        if file_type in self.productstatus_dataformats:
+            return self.productstatus_dataformats[file_type]
         try:
             resource = self.productstatus.dataformat[file_type]
         except productstatus.exceptions.ResourceNotFoundException:
             raise ecreceive.exceptions.ECReceiveProductstatusException(
                 "Data format '%s' was not found on the Productstatus server" % file_type
             )
-        logging.info('%s: Productstatus dataformat for %s' % (resource, file_type))
+        logging.info('%s: Productstatus dataformat for %s', resource, file_type)
+        self.productstatus_dataformats[file_type] = resource
         return resource
 
+    def get_productstatus_institution(self):
+        """
+        Return the Institution resource that datasets are sourced from.
+        """
+        if self.productstatus_institution is None:
+            self.productstatus_institution = self.productstatus.institution[self.productstatus_source_key]
+        return self.productstatus_institution
+
+    def get_productstatus_servicebackend(self):
+        """
+        Return the ServiceBackend resource that datasets are served from.
+        """
+        if self.productstatus_servicebackend is None:
+            self.productstatus_servicebackend = self.productstatus.servicebackend[self.productstatus_service_backend_key]
+        return self.productstatus_servicebackend
+
     def get_productstatus_product(self, dataset):
         """
         Given a Dataset object, return a matching Product resource at the
         Productstatus server, or None if no matching product is found.
         """
         name = dataset.name()
+        if name in self.productstatus_products:
+            return self.productstatus_products[name]
         qs = self.productstatus.product.objects.filter(
             source_key=name,
-            source=self.productstatus.institution[self.productstatus_source_key]
+            source=self.get_productstatus_institution(),
         )
         name_desc = "ECMWF stream name '%s'" % name
         if qs.count() == 0:
@@ -330,7 +510,8 @@ class DatasetPublisher(object):
                 "Product defined from %s was not found on the Productstatus server" % name_desc
             )
         resource = qs[0]
-        logging.info("%s: Productstatus Product for %s" % (resource, name_desc))
+        logging.info("%s: Productstatus Product for %s", resource, name_desc)
+        self.productstatus_products[name] = resource
         return resource
 
     def get_or_post_productinstance_resource(self, dataset):
@@ -366,7 +547,7 @@ class DatasetPublisher(object):
         parameters = {
             'data': data,
             'format': self.get_productstatus_dataformat(dataset),
-            'servicebackend': self.productstatus.servicebackend[self.productstatus_service_backend_key],
+            'servicebackend': self.get_productstatus_servicebackend(),
             'url': self.ecreceive_base_url + dataset.data_filename(),
             'deleted': False,
         }
@@ -381,30 +562,28 @@ class DatasetPublisher(object):
         Returns True if the dataset was completely processed, False otherwise.
         """
 
-        logging.info('===== %s: start processing =====' % filename)
-
-        full_path = os.path.join(self.spool_path, filename)
-        if not os.path.exists(full_path):
-            logging.info('Files are not present in any directory. Possible race condition; ignoring.')
-            return False
+        logging.info('===== %s: start processing =====', filename)
 
         # Instantiate Dataset object
-        dataset = ecreceive.dataset.Dataset(full_path)
-        logging.info(str(dataset))
+        dataset = ecreceive.dataset.Dataset(os.path.join(self.spool_path, filename))
 
-        # Check if both files exist
+        # Check if both files exist. If neither does, they have already been
+        # processed, possibly by another thread.
         if not dataset.complete():
-            logging.info('Incomplete dataset: %s.' % dataset.state())
+            logging.info('Incomplete dataset: %s.', dataset.state())
             return False
 
-        # Try to get a lock on this dataset
-        if not self.checkpoint_lock(dataset):
+        # Parse the filename once, up front, so that the retried submission
+        # below only reads cached values, and so that invalid filenames are
+        # rejected before the dataset is locked.
+        dataset.parse_filename(datetime.datetime.now())
+
+        # Try to get a lock on this dataset, and register a checkpoint for it
+        # to indicate that it exists
+        if not self.checkpoint_lock(dataset, ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS):
             logging.warning('Unable to get a lock on dataset, conflicting thread?')
             return False
 
-        # Register a checkpoint for this dataset to indicate that it exists
-        self.checkpoint_add(dataset, ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS)
-
         # Obtain Productstatus IDs for this product instance, and submit data files
         def productstatus_submit():
 
@@ -421,14 +600,9 @@ class DatasetPublisher(object):
             datainstance_resource = self.get_or_post_datainstance_resource(data_resource, dataset)
 
             # Everything has been saved at the remote server
-            logging.info("Now publicly available at %s until %s." % (
-                datainstance_resource.url,
-                datainstance_resource.expires.strftime('%Y-%m-%dT%H:%M:%S%z'),
-            ))
-
-            # All done
-            self.checkpoint_delete(dataset)
-            logging.info('===== %s: all done; processed successfully. =====' % dataset)
+            logging.info("Now publicly available at %s until %s.",
+                         datainstance_resource.url,
+                         datainstance_resource.expires.strftime('%Y-%m-%dT%H:%M:%S%z'))
 
             return True
 
@@ -440,8 +614,12 @@ class DatasetPublisher(object):
                 ecreceive.exceptions.ECReceiveProductstatusException
             )
         )
-        if rc:
-            return
+        if not rc:
+            self.checkpoint_unlock(dataset)
+            raise ecreceive.exceptions.TryAgainException('Processing disrupted due to external dependency failure')
+
+        # All done
+        self.checkpoint_delete(dataset)
+        logging.info('===== %s: all done; processed successfully. =====', dataset)
 
-        self.checkpoint_unlock(dataset)
-        raise ecreceive.exceptions.TryAgainException('Processing disrupted due to external dependency failure')
+        return True
@@ -0,0 +1,102 @@
+"""
+Minimal inotify bindings. Events are read directly from the inotify file
+descriptor and parsed with a precompiled struct, so that each event costs a
+single small tuple.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import struct
+
+
+# Event masks, from <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_ALL_EVENTS = 0x00000fff
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event: wd, mask, cookie, len, followed by 'len' bytes of
+# NUL-padded file name.
+EVENT_HEADER = struct.Struct('iIII')
+# Large enough for hundreds of events per read.
+BUFFER_SIZE = 64 * 1024
+
+_libc = None
+
+
+def libc():
+    """
+    Return the C library, loading it the first time.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+
+def check(rc):
+    """
+    Raise OSError if a C library call returned an error.
+    """
+    if rc < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return rc
+
+
+def parse_events(data):
+    """
+    Return a list of (wd, mask, cookie, name) tuples for the raw events in
+    'data'. Names are returned as bytes.
+    """
+    events = []
+    offset = 0
+    end = len(data)
+    header_size = EVENT_HEADER.size
+    while offset < end:
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += header_size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        events.append((wd, mask, cookie, name))
+    return events
+
+
+class Inotify(object):
+    """
+    An inotify instance, watching any number of paths.
+    """
+
+    def __init__(self):
+        self.fd = check(libc().inotify_init1(IN_CLOEXEC))
+
+    def add_watch(self, path, mask=IN_ALL_EVENTS):
+        """
+        Start watching 'path' for the events in 'mask'. Returns the watch
+        descriptor.
+        """
+        return check(libc().inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def read_events(self):
+        """
+        Block until at least one event is available, and return all pending
+        events; see parse_events().
+        """
+        return parse_events(os.read(self.fd, BUFFER_SIZE))
+
+    def close(self):
+        os.close(self.fd)
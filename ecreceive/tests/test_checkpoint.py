@@ -2,7 +2,7 @@ import tempfile
 
 import ecreceive.checkpoint
 
-from nose.tools import raises
+import pytest
 
 
 def setup_with_tempfile(json):
@@ -13,25 +13,12 @@ def setup_with_tempfile(json):
     return tmpfile, ecreceive.checkpoint.Checkpoint(tmpfile.name)
 
 
-@raises(IOError)
-def test_bogus_file_add():
+def test_bogus_file():
     """
-    Test a Checkpoint with an invalid path
-    raises an exception when making changes.
+    Test that a Checkpoint with an invalid path raises an exception.
     """
-    c = ecreceive.checkpoint.Checkpoint('/this/is/no/file')
-    assert not c.keys()
-    c.add('my-favourite-key', 1)
-
-
-def test_bogus_file_delete():
-    """
-    Test a Checkpoint with an invalid path
-    raises an exception when adding a flag.
-    """
-    c = ecreceive.checkpoint.Checkpoint('/this/is/no/file')
-    assert not c.keys()
-    c.delete('my-favourite-key')
+    with pytest.raises(IOError):
+        ecreceive.checkpoint.Checkpoint('/this/is/no/file')
 
 
 def test_load_missing():
@@ -93,6 +80,20 @@ def test_delete_save():
     assert checkpoint.get('a') == 0
 
 
+def test_keys_paginated():
+    """
+    Test that keys can be read a page at a time, and that deleting keys
+    from a page that has been read does not skip keys on the next.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"c": 1, "a": 1, "d": 1, "b": 1, "e": 1}')
+    assert checkpoint.keys() == ['a', 'b', 'c', 'd', 'e']
+    assert checkpoint.keys(limit=2) == ['a', 'b']
+    checkpoint.delete('a')
+    checkpoint.delete('b')
+    assert checkpoint.keys('b', 2) == ['c', 'd']
+    assert checkpoint.keys('d', 2) == ['e']
+
+
 def test_get_nosave():
     """
     Test that get for an unknown key does not stores new state in memory or file.
@@ -102,3 +103,76 @@ def test_get_nosave():
 
     cp_reload = ecreceive.checkpoint.Checkpoint(tmpfile.name)
     assert 'b' not in cp_reload.keys()
+
+
+def test_lock_unlock():
+    """
+    Test that a key can only be locked once, and that unlocking it
+    preserves the other flags.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"a": 1}')
+    assert checkpoint.lock('a')
+    assert not checkpoint.lock('a')
+    assert checkpoint.get('a') == 1 | ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED
+
+    cp_reload = ecreceive.checkpoint.Checkpoint(tmpfile.name)
+    assert cp_reload.get('a') == 1 | ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED
+
+    checkpoint.unlock('a')
+    assert checkpoint.get('a') == 1
+    assert checkpoint.lock('a')
+
+
+def test_lock_add():
+    """
+    Test that flags given when locking a key are only added if the lock is
+    obtained.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"a": 4}')
+    assert not checkpoint.lock('a', ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS)
+    assert checkpoint.get('a') == ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED
+    assert checkpoint.lock('b', ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS)
+    assert checkpoint.get('b') == (ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED |
+                                   ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS)
+
+
+def test_unlock_all():
+    """
+    Test that unlocking all keys preserves the other flags.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"a": 5, "b": 4, "c": 1}')
+    checkpoint.unlock_all()
+    assert checkpoint.get('a') == 1
+    assert checkpoint.get('b') == 0
+    assert checkpoint.get('c') == 1
+
+
+def test_convert_json():
+    """
+    Test that a JSON state file is converted into a database.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"a": 1}')
+    with open(tmpfile.name, 'rb') as f:
+        assert f.read(len(ecreceive.checkpoint.SQLITE_HEADER)) == ecreceive.checkpoint.SQLITE_HEADER
+
+    cp_reload = ecreceive.checkpoint.Checkpoint(tmpfile.name)
+    assert cp_reload.get('a') == 1
+
+
+def test_batch():
+    """
+    Test that operations in a batch see each other, and are only stored in
+    the file at the end of the batch.
+    """
+    tmpfile, checkpoint = setup_with_tempfile('{"a": 1}')
+    cp_other = ecreceive.checkpoint.Checkpoint(tmpfile.name)
+    with checkpoint.batch():
+        checkpoint.add('b', 1)
+        assert checkpoint.lock('b')
+        assert not checkpoint.lock('b')
+        checkpoint.delete('a')
+        assert checkpoint.get('b') == 1 | ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED
+        assert cp_other.get('a') == 1
+        assert cp_other.get('b') == 0
+    assert cp_other.get('a') == 0
+    assert cp_other.get('b') == 1 | ecreceive.checkpoint.CHECKPOINT_DATASET_LOCKED
@@ -2,51 +2,43 @@ import tempfile
 import datetime
 import dateutil.tz
 import os
+import pathlib
 
 import ecreceive
 import ecreceive.dataset
 import ecreceive.exceptions
 
-from nose.tools import with_setup, raises
+import pytest
 
-dataset = None
+from unittest.mock import patch, Mock
 
 
-def setup_bogus():
+@pytest.fixture
+def bogus_dataset():
     """
-    Setup function: set up a bogus dataset.
+    Fixture: a bogus dataset.
     """
-    global dataset
-    dataset = ecreceive.dataset.Dataset('/tmp/foo')
+    return ecreceive.dataset.Dataset('/tmp/foo')
 
 
-def setup_real_files():
+@pytest.fixture
+def real_dataset():
     """
-    Setup function: set up a valid dataset with real files.
+    Fixture: a valid dataset with real files.
     """
-    global dataset
     path = os.path.join(os.path.dirname(__file__), 'fixtures', 'BFS11120600111511001')
-    dataset = ecreceive.dataset.Dataset(path)
-
-
-def setup_temporary_files():
-    """
-    Setup function: create a named temporary file "dataset" with an md5sum file.
-    """
-    global dataset
-    data = tempfile.NamedTemporaryFile(delete=False)
-    md5 = open(data.name + '.md5', 'w+b')
-    data.write(b'test\n')
-    md5.write(b'd8e8fca2dc0f896fd7cb4cb0031ba249')
-    dataset = ecreceive.dataset.Dataset(data.name)
+    return ecreceive.dataset.Dataset(path)
 
 
-def teardown_temporary_files():
+@pytest.fixture
+def temporary_dataset(tmp_path):
     """
-    Teardown function: destroy the temporary files.
+    Fixture: a temporary file "dataset" with an md5sum file.
     """
-    os.unlink(dataset.data_path)
-    os.unlink(dataset.md5_path)
+    data = tmp_path / 'dataset'
+    data.write_bytes(b'test\n')
+    (tmp_path / 'dataset.md5').write_bytes(b'd8e8fca2dc0f896fd7cb4cb0031ba249')
+    return ecreceive.dataset.Dataset(data)
 
 
 def test_init_data():
@@ -69,281 +61,392 @@ def test_init_md5():
     assert dataset.md5_path == '/tmp/foo.md5'
 
 
-@with_setup(setup_bogus)
-def test_is_md5_path():
+def test_init_pathlike():
+    """
+    Test that a Dataset object can be instantiated from a path-like object.
+    """
+    dataset = ecreceive.dataset.Dataset(pathlib.PurePath('/tmp/foo.md5'))
+    assert dataset.data_path == '/tmp/foo'
+    assert dataset.md5_path == '/tmp/foo.md5'
+
+
+def test_is_md5_path(bogus_dataset):
     """
     Test that the Dataset class will identify a path ending with .md5 as a
     valid md5sum file path.
     """
-    assert dataset.is_md5_path('/path/to/foo/bar.md5')
+    assert bogus_dataset.is_md5_path('/path/to/foo/bar.md5')
 
 
-@with_setup(setup_bogus)
-def test_data_to_md5_path():
+def test_data_to_md5_path(bogus_dataset):
     """
     Test that an md5sum file path can be derived from a data file path.
     """
-    assert dataset.data_to_md5_path('/path/to/foo/bar') == '/path/to/foo/bar.md5'
+    assert bogus_dataset.data_to_md5_path('/path/to/foo/bar') == '/path/to/foo/bar.md5'
 
 
-@with_setup(setup_bogus)
-def test_md5_to_data_path():
+def test_md5_to_data_path(bogus_dataset):
     """
     Test that an data file path can be derived from a md5sum file path.
     """
-    assert dataset.md5_to_data_path('/path/to/foo/bar.md5') == '/path/to/foo/bar'
+    assert bogus_dataset.md5_to_data_path('/path/to/foo/bar.md5') == '/path/to/foo/bar'
 
 
-@raises(ecreceive.exceptions.ECReceiveException)
-@with_setup(setup_bogus)
-def test_invalid_md5_to_data_path():
+def test_invalid_md5_to_data_path(bogus_dataset):
     """
     Test that deriving a data file path from an md5sum file path which does not
     end with .md5 will throw an error.
     """
-    dataset.md5_to_data_path('/path/to/foo/bar.md4')
+    with pytest.raises(ecreceive.exceptions.ECReceiveException):
+        bogus_dataset.md5_to_data_path('/path/to/foo/bar.md4')
 
 
-@with_setup(setup_bogus)
-def test_has_no_data_file():
+def test_has_no_data_file(bogus_dataset):
     """
     Test that a Dataset with a missing data file will report that correctly.
     """
-    assert dataset.has_data_file() is False
+    assert bogus_dataset.has_data_file() is False
 
 
-@with_setup(setup_bogus)
-def test_has_no_md5_file():
+def test_has_no_md5_file(bogus_dataset):
     """
     Test that a Dataset with a missing md5sum file will report that correctly.
     """
-    assert dataset.has_md5_file() is False
+    assert bogus_dataset.has_md5_file() is False
 
 
-@with_setup(setup_bogus)
-def test_incomplete():
+def test_incomplete(bogus_dataset):
     """
     Test that a Dataset which is missing both the data file and the md5sum file
     is reported as incomplete.
     """
-    assert dataset.complete() is False
+    assert bogus_dataset.complete() is False
 
 
-@with_setup(setup_temporary_files)
-def test_incomplete_data_missing():
+def test_incomplete_data_missing(temporary_dataset):
     """
     Test that a Dataset which is missing the data file, but not the md5sum
     file, is reported as incomplete.
     """
-    os.unlink(dataset.data_path)
-    assert dataset.complete() is False
-    os.unlink(dataset.md5_path)
+    os.unlink(temporary_dataset.data_path)
+    assert temporary_dataset.complete() is False
+    os.unlink(temporary_dataset.md5_path)
 
 
-@with_setup(setup_temporary_files)
-def test_incomplete_md5_missing():
+def test_incomplete_md5_missing(temporary_dataset):
     """
     Test that a Dataset which is missing the md5sum file, but not the data
     file, is reported as incomplete.
     """
-    os.unlink(dataset.md5_path)
-    assert dataset.complete() is False
-    os.unlink(dataset.data_path)
+    os.unlink(temporary_dataset.md5_path)
+    assert temporary_dataset.complete() is False
+    os.unlink(temporary_dataset.data_path)
 
 
-@with_setup(setup_real_files)
-def test_has_data_file():
+def test_has_data_file(real_dataset):
     """
     Test that a Dataset recognizes that its data file is on disk.
     """
-    assert dataset.has_data_file()
+    assert real_dataset.has_data_file()
 
 
-@with_setup(setup_real_files)
-def test_has_md5_file():
+def test_has_md5_file(real_dataset):
     """
     Test that a Dataset recognizes that its md5sum file is on disk.
     """
-    assert dataset.has_md5_file()
+    assert real_dataset.has_md5_file()
+
+
+def test_refresh(temporary_dataset):
+    """
+    Test that a Dataset remembers which files exist until refreshed.
+    """
+    assert temporary_dataset.complete()
+    os.unlink(temporary_dataset.data_path)
+    os.unlink(temporary_dataset.md5_path)
+    assert temporary_dataset.complete()
+    temporary_dataset.refresh()
+    assert temporary_dataset.complete() is False
 
 
-@with_setup(setup_real_files)
-def test_complete():
+def test_state(temporary_dataset):
+    """
+    Test that the state of a Dataset reflects which of its files are on disk.
+    """
+    assert temporary_dataset.state() == 'complete'
+    os.unlink(temporary_dataset.md5_path)
+    temporary_dataset.refresh()
+    assert temporary_dataset.state() == 'missing md5sum'
+    os.rename(temporary_dataset.data_path, temporary_dataset.md5_path)
+    temporary_dataset.refresh()
+    assert temporary_dataset.state() == 'missing data file'
+    os.unlink(temporary_dataset.md5_path)
+    temporary_dataset.refresh()
+    assert temporary_dataset.state() == 'missing'
+
+
+def test_delete(temporary_dataset):
+    """
+    Test that deleting a Dataset removes both files.
+    """
+    temporary_dataset.delete()
+    assert temporary_dataset.complete() is False
+    assert not os.path.exists(temporary_dataset.data_path)
+    assert not os.path.exists(temporary_dataset.md5_path)
+
+
+def test_complete(real_dataset):
     """
     Test that a Dataset with both a data file and an md5sum file on disk
     reports the dataset as complete.
     """
-    assert dataset.complete()
+    assert real_dataset.complete()
 
 
-@with_setup(setup_real_files)
-def test_read_md5sum():
+def test_read_md5sum(real_dataset):
     """
     Test that the md5sum inside the md5sum file is read and stored in the
     correct variable.
     """
-    dataset.read_md5sum()
-    assert dataset.md5_key == '634eece2300fef37519acec88fc6f2d8'
+    real_dataset.read_md5sum()
+    assert real_dataset.md5_key == '634eece2300fef37519acec88fc6f2d8'
 
 
-@raises(ecreceive.exceptions.ECReceiveException)
-@with_setup(setup_bogus)
-def test_read_md5sum_missing():
+def test_read_md5sum_once(temporary_dataset):
+    """
+    Test that the md5sum file is only read the first time.
+    """
+    temporary_dataset.read_md5sum()
+    with patch('os.open') as os_open:
+        temporary_dataset.read_md5sum()
+    assert not os_open.called
+    assert temporary_dataset.md5_key == 'd8e8fca2dc0f896fd7cb4cb0031ba249'
+
+
+def test_read_md5sum_missing(bogus_dataset):
     """
     Test that an exception is thrown when trying to read from a non-existing
     md5sum file.
     """
-    dataset.read_md5sum()
+    with pytest.raises(ecreceive.exceptions.ECReceiveException):
+        bogus_dataset.read_md5sum()
 
 
-@raises(ecreceive.exceptions.InvalidDataException)
-@with_setup(setup_temporary_files, teardown_temporary_files)
-def test_read_md5sum_too_short():
+def test_read_md5sum_too_short(temporary_dataset):
     """
     Test that reading an md5sum file with too little data throws an exception.
     """
-    with open(dataset.md5_path, 'w+b') as f:
+    with open(temporary_dataset.md5_path, 'w+b') as f:
         f.write(b'abcdef')
-    dataset.read_md5sum()
+    with pytest.raises(ecreceive.exceptions.InvalidDataException):
+        temporary_dataset.read_md5sum()
+
+
+def test_read_md5sum_not_hexadecimal(temporary_dataset):
+    """
+    Test that reading an md5sum file which does not contain a hexadecimal
+    md5sum throws an exception.
+    """
+    with open(temporary_dataset.md5_path, 'w+b') as f:
+        f.write(b'this is not a hexadecimal md5sum')
+    with pytest.raises(ecreceive.exceptions.InvalidDataException):
+        temporary_dataset.read_md5sum()
 
 
-@with_setup(setup_real_files)
-def test_calculate_md5sum():
+def test_calculate_md5sum(real_dataset):
     """
     Test that the md5sum of the data file is calculated correctly.
     """
-    dataset.calculate_md5sum()
-    assert dataset.md5_result == '634eece2300fef37519acec88fc6f2d8'
+    real_dataset.calculate_md5sum()
+    assert real_dataset.md5_result == '634eece2300fef37519acec88fc6f2d8'
+
+
+def test_calculate_md5sum_readinto(real_dataset):
+    """
+    Test that the md5sum of the data file is calculated correctly without
+    hashlib.file_digest.
+    """
+    with patch('ecreceive.dataset.hashlib', Mock(spec=[])):
+        real_dataset.calculate_md5sum()
+    assert real_dataset.md5_result == '634eece2300fef37519acec88fc6f2d8'
 
 
-@raises(ecreceive.exceptions.ECReceiveException)
-@with_setup(setup_temporary_files)
-def test_calculate_md5sum_missing():
+def test_valid_empty(temporary_dataset):
+    """
+    Test that an empty data file is validated without reading it.
+    """
+    open(temporary_dataset.data_path, 'wb').close()
+    with open(temporary_dataset.md5_path, 'wb') as f:
+        f.write(b'd41d8cd98f00b204e9800998ecf8427e')
+    with patch('ecreceive.dataset.md5_read', Mock(side_effect=AssertionError)):
+        assert temporary_dataset.valid()
+
+
+def test_calculate_md5sum_missing(temporary_dataset):
     """
     Test that trying to calculate the md5sum of a missing file throws an
     exception.
     """
-    os.unlink(dataset.data_path)
-    dataset.calculate_md5sum()
-    os.unlink(dataset.md5_path)
+    os.unlink(temporary_dataset.data_path)
+    with pytest.raises(ecreceive.exceptions.ECReceiveException):
+        temporary_dataset.calculate_md5sum()
 
 
-@with_setup(setup_real_files)
-def test_valid():
+def test_valid(real_dataset):
     """
     Test that comparing a valid data file to a md5sum file returns True, and
     that the md5_key and md5_result variables are set.
     """
-    assert dataset.valid()
-    assert dataset.md5_key == '634eece2300fef37519acec88fc6f2d8'
-    assert dataset.md5_result == dataset.md5_key
+    assert real_dataset.valid()
+    assert real_dataset.md5_key == '634eece2300fef37519acec88fc6f2d8'
+    assert real_dataset.md5_result == real_dataset.md5_key
 
 
-@with_setup(setup_temporary_files, teardown_temporary_files)
-def test_invalid():
+def test_invalid(temporary_dataset):
     """
     Test that validating a data set against a mismatching md5sum returns False.
     """
-    with open(dataset.data_path, 'w+b') as f:
+    with open(temporary_dataset.data_path, 'w+b') as f:
+        f.write(b'invalid data')
+    assert temporary_dataset.valid() is False
+
+
+def test_valid_data_changed(temporary_dataset):
+    """
+    Test that validating a data set again after the data file has changed
+    does not use the previously calculated md5sum.
+    """
+    assert temporary_dataset.valid()
+    with open(temporary_dataset.data_path, 'w+b') as f:
         f.write(b'invalid data')
-    assert dataset.valid() is False
+    assert temporary_dataset.valid() is False
 
 
-@with_setup(setup_temporary_files)
-def test_move():
+def test_valid_rewritten_in_place(temporary_dataset):
+    """
+    Test that validating a data set after the data file has been rewritten
+    with the same size and modification time hashes it again.
+    """
+    assert temporary_dataset.valid()
+    st = os.stat(temporary_dataset.data_path)
+    with open(temporary_dataset.data_path, 'r+b') as f:
+        f.write(b'TEST\n')
+    os.utime(temporary_dataset.data_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert temporary_dataset.valid() is False
+
+
+def test_move(temporary_dataset):
     """
     Test that moving a dataset to a different directory works.
     """
     tmp_dir = tempfile.mkdtemp()
-    dataset.move(tmp_dir)
-    assert dataset.data_path[:len(tmp_dir)] == tmp_dir
-    assert dataset.md5_path[:len(tmp_dir)] == tmp_dir
-    assert dataset.has_data_file()
-    assert dataset.has_md5_file()
-    os.unlink(dataset.data_path)
-    os.unlink(dataset.md5_path)
+    temporary_dataset.move(tmp_dir)
+    assert temporary_dataset.data_path[:len(tmp_dir)] == tmp_dir
+    assert temporary_dataset.md5_path[:len(tmp_dir)] == tmp_dir
+    assert temporary_dataset.has_data_file()
+    assert temporary_dataset.has_md5_file()
+    os.unlink(temporary_dataset.data_path)
+    os.unlink(temporary_dataset.md5_path)
+    os.rmdir(tmp_dir)
+
+
+def test_move_other_filesystem(temporary_dataset):
+    """
+    Test that moving a dataset to a directory on a different file system
+    works.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    with patch('ecreceive.dataset.same_filesystem', Mock(return_value=False)):
+        temporary_dataset.move(tmp_dir)
+    assert temporary_dataset.data_path[:len(tmp_dir)] == tmp_dir
+    assert temporary_dataset.md5_path[:len(tmp_dir)] == tmp_dir
+    assert temporary_dataset.has_data_file()
+    assert temporary_dataset.has_md5_file()
+    os.unlink(temporary_dataset.data_path)
+    os.unlink(temporary_dataset.md5_path)
     os.rmdir(tmp_dir)
 
 
-@raises(OSError)
-@with_setup(setup_temporary_files, teardown_temporary_files)
-def test_move_nonexistent_directory():
+def test_move_nonexistent_directory(temporary_dataset):
     """
     Test that moving a dataset to a nonexistent directory throws an exception.
     """
-    dataset.move('/dev/null/nonexistent/directory')
+    with pytest.raises(OSError):
+        temporary_dataset.move('/dev/null/nonexistent/directory')
 
 
-@raises(ecreceive.exceptions.ECReceiveException)
-@with_setup(setup_bogus)
-def test_move_incomplete_dataset():
+def test_move_incomplete_dataset(bogus_dataset):
     """
     Test that moving an incomplete dataset throws an exception.
     """
-    dataset.move('/tmp')
+    with pytest.raises(ecreceive.exceptions.ECReceiveException):
+        bogus_dataset.move('/tmp')
 
 
-@with_setup(setup_real_files)
-def test_dataset_name():
+def test_dataset_name(real_dataset):
     """
     Test that the correct dataset name is returned.
     """
-    assert dataset.name() == 'BF'
+    assert real_dataset.name() == 'BF'
 
 
-@with_setup(setup_real_files)
-def test_dataset_stream_use():
+def test_dataset_stream_use(real_dataset):
     """
     Test that the correct dataset stream use flag is returned.
     """
-    assert dataset.stream_use() == 'S'
+    assert real_dataset.stream_use() == 'S'
 
 
-@with_setup(setup_real_files)
-def test_dataset_version():
+def test_dataset_version(real_dataset):
     """
     Test that the correct dataset version is returned.
     """
-    assert dataset.version() == 1
+    assert real_dataset.version() == 1
 
 
-@with_setup(setup_real_files)
-def test_analysis_start_time():
+def test_analysis_start_time(real_dataset):
     """
     Test that the correct dataset analysis time is returned.
     """
     comparison_timestamp = datetime.datetime(2015, 11, 12, 6, 0, 0, tzinfo=dateutil.tz.tzutc())
     # replacing year with 2015 since filenames do not contain the year, and the
     # current year will be used instead.
-    analysis_start_time = dataset.analysis_start_time().replace(year=2015)
+    analysis_start_time = real_dataset.analysis_start_time().replace(year=2015)
     assert analysis_start_time == comparison_timestamp
 
 
-@with_setup(setup_real_files)
-def test_analysis_end_time():
+def test_analysis_end_time(real_dataset):
     """
     Test that the correct dataset end time is returned.
     """
     comparison_timestamp = datetime.datetime(2015, 11, 15, 11, 0, 0, tzinfo=dateutil.tz.tzutc())
     # replacing year with 2015, see above test.
-    analysis_end_time = dataset.analysis_end_time().replace(year=2015)
+    analysis_end_time = real_dataset.analysis_end_time().replace(year=2015)
     assert analysis_end_time == comparison_timestamp
 
 
-@with_setup(setup_bogus)
-@raises(ecreceive.exceptions.ECReceiveException)
-def test_reference_times_missing_dataset():
+def test_reference_times_missing_dataset(bogus_dataset):
     """
     Test that an exception is thrown when trying to read reference times from a
     non-existant data set.
     """
-    dataset.analysis_start_time()
+    with pytest.raises(ecreceive.exceptions.ECReceiveException):
+        bogus_dataset.analysis_start_time()
+
+
+def test_invalid_filename():
+    """
+    Test that an exception is thrown when trying to read filename components
+    from a data set with an unexpected filename.
+    """
+    dataset = ecreceive.dataset.Dataset('/tmp/BFS1112060011151100x')
+    with pytest.raises(ecreceive.exceptions.InvalidFilenameException):
+        dataset.version()
 
 
-@with_setup(setup_real_files)
-def test_file_type():
+def test_file_type(real_dataset):
     """
     Test that the correct dataset file type is returned.
     """
-    file_type = dataset.file_type()
+    file_type = real_dataset.file_type()
     assert file_type == 'grib'
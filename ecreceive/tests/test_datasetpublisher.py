@@ -1,13 +1,22 @@
 import tempfile
 import os
+import time
+
+import pytest
 
 import ecreceive
 import ecreceive.dataset
 import ecreceive.exceptions
 
-# for python3: from unittest.mock import MagicMock, Mock
-from mock import MagicMock, Mock
-from nose.tools import raises
+from unittest.mock import MagicMock, Mock, patch
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    """
+    Make retries in ecreceive.retry_n() happen immediately.
+    """
+    monkeypatch.setattr(time, 'sleep', lambda *_: None)
 
 
 def make_bogus_datasetpublisher(checkpoint, in_dir):
@@ -55,7 +64,6 @@ def test_process_only_md5():
     dsp.process_file(md5_name)
 
 
-@raises(ecreceive.exceptions.InvalidFilenameException)
 def test_process_bad_fileformat():
     in_dir, cp = setup_dirs()
     dsp = make_bogus_datasetpublisher(cp, in_dir)
@@ -67,12 +75,12 @@ def test_process_bad_fileformat():
     with open(md5_name, 'wb') as md5:
         md5.write(b'd8e8fca2dc0f896fd7cb4cb0031ba249')  # md5sum of 'test\n'
 
-    dsp.process_file(md5_name)
-
+    with pytest.raises(ecreceive.exceptions.InvalidFilenameException):
+        dsp.process_file(md5_name)
+    assert not dsp.checkpoint_socket.send_pyobj.called
 
-def test_process_data():
-    in_dir, cp = setup_dirs()
 
+def make_productstatus_datasetpublisher(checkpoint, in_dir):
     mock_datainstance = MagicMock()
     mock_productstatus_api = MagicMock()
     mock_productstatus_api.datainstance.find_or_create = Mock(return_value=mock_datainstance)
@@ -82,7 +90,7 @@ def test_process_data():
     base_url = "http://hei.ho/"
 
     dsp = ecreceive.dataset.DatasetPublisher(
-        cp,
+        checkpoint,
         base_url,
         120,
         productstatus_service_backend,
@@ -90,20 +98,47 @@ def test_process_data():
         in_dir,
         mock_productstatus_api,
     )
+    return dsp, mock_productstatus_api
 
-    data_filename = "BFS11120600111511001"
+
+def make_dataset_files(in_dir, data_filename):
     data_name = os.path.join(in_dir, data_filename)
     md5_name = data_name + '.md5'
     with open(data_name, 'wb') as data:
         data.write(b'test\n')
     with open(md5_name, 'wb') as md5:
         md5.write(b'd8e8fca2dc0f896fd7cb4cb0031ba249')  # md5sum of 'test\n'
+    return md5_name
 
-    dsp.process_file(md5_name)
 
+def test_process_data():
+    in_dir, cp = setup_dirs()
+    dsp, mock_productstatus_api = make_productstatus_datasetpublisher(cp, in_dir)
+
+    data_filename = "BFS11120600111511001"
+    md5_name = make_dataset_files(in_dir, data_filename)
+
+    assert dsp.process_file(md5_name) is True
+
+    cp.send_pyobj.assert_any_call(('lock', data_filename, ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS))
+    cp.send_pyobj.assert_called_with(('delete', data_filename))
     assert mock_productstatus_api.datainstance.find_or_create.called
 
 
+def test_process_data_productstatus_lookups_cached():
+    in_dir, cp = setup_dirs()
+    dsp, mock_productstatus_api = make_productstatus_datasetpublisher(cp, in_dir)
+
+    assert dsp.process_file(make_dataset_files(in_dir, "BFS11120600111511001")) is True
+    assert dsp.process_file(make_dataset_files(in_dir, "BFS11120600111511002")) is True
+
+    assert mock_productstatus_api.dataformat.__getitem__.call_count == 1
+    assert mock_productstatus_api.product.objects.filter.call_count == 1
+    assert mock_productstatus_api.institution.__getitem__.call_count == 1
+    assert mock_productstatus_api.servicebackend.__getitem__.call_count == 1
+    assert mock_productstatus_api.datainstance.find_or_create.call_count == 2
+
+
 class MyProblem(Exception):
     pass
 
@@ -124,31 +159,28 @@ class FailRepeatedly(object):
             raise self.exception()
 
 
-def test_retry_0():
-    f = FailRepeatedly(0)
-    ecreceive.retry_n(f, interval=0.01, exceptions=(MyProblem,), warning=1, error=2, give_up=3)
-    assert f.count == 1
-
-
-def test_retry_1():
-    f = FailRepeatedly(1)
-    ecreceive.retry_n(f, interval=0.01, exceptions=(MyProblem,), warning=1, error=2, give_up=3)
-    assert f.count == 2
-
-
-def test_retry_10():
-    f = FailRepeatedly(10)
-    ecreceive.retry_n(f, interval=0.01, exceptions=(MyProblem,), warning=1, error=2, give_up=3)
-    assert f.count == 3
-
-
-@raises(NotMyProblem)
-def test_retry_other():
-    f = FailRepeatedly(10, NotMyProblem)
-    ecreceive.retry_n(f, interval=0.01, exceptions=(MyProblem,), warning=1, error=2, give_up=3)
-
-
-def test_retry_indefinitely():
-    f = FailRepeatedly(10)
-    ecreceive.retry_n(f, interval=0.01, exceptions=(MyProblem,), warning=1, error=2, give_up=-1)
-    assert f.count == 11
+@pytest.mark.parametrize("n_fail, give_up, expected_count, exc", [
+    (0, 3, 1, MyProblem),
+    (1, 3, 2, MyProblem),
+    (10, 3, 3, MyProblem),
+    (10, 3, 1, NotMyProblem),
+    (10, -1, 11, MyProblem),
+])
+def test_retry(n_fail, give_up, expected_count, exc):
+    f = FailRepeatedly(n_fail, exc)
+    if exc is MyProblem:
+        ecreceive.retry_n(f, exceptions=(MyProblem,), warning=1, error=2, give_up=give_up)
+    else:
+        with pytest.raises(exc):
+            ecreceive.retry_n(f, exceptions=(MyProblem,), warning=1, error=2, give_up=give_up)
+    assert f.count == expected_count
+
+
+def test_retry_backoff():
+    f = FailRepeatedly(5)
+    with patch('time.sleep') as sleep:
+        ecreceive.retry_n(f, interval=1, exceptions=(MyProblem,), warning=1, error=2, give_up=-1, max_interval=4)
+    delays = [c[0][0] for c in sleep.call_args_list]
+    assert len(delays) == 5
+    for delay, expected in zip(delays, [1, 2, 4, 4, 4]):
+        assert expected <= delay <= expected + 0.1
@@ -0,0 +1,31 @@
+import ecreceive.inotify
+
+
+def test_parse_events():
+    """
+    Test that raw inotify events are split into tuples, with the NUL padding
+    removed from the file names.
+    """
+    data = ecreceive.inotify.EVENT_HEADER.pack(1, ecreceive.inotify.IN_CLOSE_WRITE, 0, 8) + b'foo.md5\0'
+    data += ecreceive.inotify.EVENT_HEADER.pack(1, ecreceive.inotify.IN_OPEN, 0, 16) + b'bar' + b'\0' * 13
+    events = ecreceive.inotify.parse_events(data)
+    assert events == [
+        (1, ecreceive.inotify.IN_CLOSE_WRITE, 0, b'foo.md5'),
+        (1, ecreceive.inotify.IN_OPEN, 0, b'bar'),
+    ]
+
+
+def test_read_events(tmp_path):
+    """
+    Test that closing a file opened for writing in a watched directory
+    generates an IN_CLOSE_WRITE event.
+    """
+    inotify = ecreceive.inotify.Inotify()
+    try:
+        wd = inotify.add_watch(tmp_path, ecreceive.inotify.IN_CLOSE_WRITE)
+        with open(tmp_path / 'foo.md5', 'wb') as f:
+            f.write(b'test\n')
+        events = inotify.read_events()
+    finally:
+        inotify.close()
+    assert events == [(wd, ecreceive.inotify.IN_CLOSE_WRITE, 0, b'foo.md5')]
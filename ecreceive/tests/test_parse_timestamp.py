@@ -3,8 +3,7 @@ from ecreceive import force_utc, parse_filename_timestamp
 import datetime
 import dateutil.tz
 
-# from nose.tools import with_setup, raises
-# from unittest.case import SkipTest
+import pytest
 
 
 def test_force_utc():
@@ -88,3 +87,11 @@ def test_parse_filename_timestamp_missing_everything():
     """
     timestamp = parse_filename_timestamp('________', datetime.datetime.now())
     assert timestamp is None
+
+
+def test_parse_filename_timestamp_invalid():
+    """
+    Test that the timestamp parser rejects timestamps that are not dates.
+    """
+    with pytest.raises(ValueError):
+        parse_filename_timestamp('13011325', datetime.datetime.now())
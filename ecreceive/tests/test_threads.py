@@ -0,0 +1,225 @@
+import os
+import time
+import threading
+import collections
+
+import zmq
+import pytest
+
+from unittest.mock import Mock
+
+import ecreceive.checkpoint
+import ecreceive.dataset
+import ecreceive.threads
+
+
+@pytest.fixture
+def context():
+    """
+    Fixture: a ZeroMQ context of its own, so that every test can bind the
+    inproc endpoints again. Threads started by a test are left running.
+    """
+    return zmq.Context()
+
+
+@pytest.fixture
+def killswitch():
+    """
+    Fixture: the event set by crashing threads.
+    """
+    return threading.Event()
+
+
+def req_socket(context, endpoint):
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, 5000)
+    socket.connect(endpoint)
+    return socket
+
+
+def test_checkpoint_thread_concurrent_requests(context, killswitch, tmp_path):
+    """
+    Test that requests queued by several clients at the same time are
+    committed in one batch, and that every client gets its own reply.
+    """
+    checkpoint_file = str(tmp_path / 'state.db')
+    thread = ecreceive.threads.CheckpointThread(context, killswitch, checkpoint_file)
+    batch_sizes = []
+    recv_requests = thread.recv_requests
+
+    def record_batch_size():
+        requests = recv_requests()
+        batch_sizes.append(len(requests))
+        return requests
+    thread.recv_requests = record_batch_size
+
+    # Queue all requests before the thread starts receiving them.
+    clients = [req_socket(context, ecreceive.threads.ZMQ_CHECKPOINT_SOCKET) for i in range(8)]
+    for i, client in enumerate(clients):
+        client.send_pyobj(('add', 'key%d' % i, i))
+    thread.start()
+    for client in clients:
+        assert client.recv_pyobj() is None
+    assert batch_sizes[0] == len(clients)
+
+    for i, client in enumerate(clients):
+        client.send_pyobj(('get', 'key%d' % i))
+    for i, client in enumerate(clients):
+        assert client.recv_pyobj() == i
+
+    checkpoint = ecreceive.checkpoint.Checkpoint(checkpoint_file)
+    for i in range(len(clients)):
+        assert checkpoint.get('key%d' % i) == i
+    assert not killswitch.is_set()
+
+
+def start_worker(context, jobs, lock, release=None):
+    """
+    Start a thread that requests jobs from the distribution thread like a
+    WorkerThread, and appends the jobs it receives to 'jobs'. If 'release'
+    is given, the worker does not ask for another job until it is set.
+    """
+    def run():
+        socket = context.socket(zmq.REQ)
+        socket.connect(ecreceive.threads.ZMQ_WORKERS_SOCKET)
+        while True:
+            socket.send(ecreceive.threads.WORKER_READY)
+            job = socket.recv()
+            with lock:
+                jobs.append(job)
+            if release is not None:
+                release.wait()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_distribution_slow_worker(context, killswitch):
+    """
+    Test that a worker busy with a slow job does not hold up jobs that other
+    workers are free to take, and that every job is delivered exactly once.
+    """
+    ecreceive.threads.DistributionThread(context, killswitch).start()
+    submit = context.socket(zmq.PUSH)
+    submit.connect(ecreceive.threads.ZMQ_JOB_SUBMIT_SOCKET)
+    lock = threading.Lock()
+    release = threading.Event()
+
+    # The slow worker is the only one when the first job arrives.
+    slow_jobs = []
+    start_worker(context, slow_jobs, lock, release)
+    submit.send(b'slow')
+    assert wait_for(lambda: slow_jobs)
+
+    fast_jobs = [[], [], []]
+    for jobs in fast_jobs:
+        start_worker(context, jobs, lock)
+    expected = [b'job%d' % i for i in range(30)]
+    # Single jobs, and several jobs in one message.
+    for job in expected[:10]:
+        submit.send(job)
+    submit.send_multipart(expected[10:])
+
+    try:
+        assert wait_for(lambda: sum(map(len, fast_jobs)) == len(expected))
+        assert slow_jobs == [b'slow']
+        assert sorted(sum(fast_jobs, [])) == sorted(expected)
+    finally:
+        release.set()
+    assert not killswitch.is_set()
+
+
+@pytest.mark.parametrize('n_keys', [0, 1, 2, 4, 5])
+def test_process_incomplete_checkpoints_paginated(context, killswitch, tmp_path, monkeypatch, n_keys):
+    """
+    Test that every checkpointed file is submitted exactly once when the
+    checkpoint is read a page at a time, including at page boundaries.
+    """
+    monkeypatch.setattr(ecreceive.threads, 'CHECKPOINT_KEYS_PAGE_SIZE', 2)
+    checkpoint_file = str(tmp_path / 'state.db')
+    keys = ['key%d' % i for i in range(n_keys)]
+    checkpoint = ecreceive.checkpoint.Checkpoint(checkpoint_file)
+    for key in keys:
+        checkpoint.add(key, ecreceive.checkpoint.CHECKPOINT_DATASET_EXISTS)
+    ecreceive.threads.CheckpointThread(context, killswitch, checkpoint_file).start()
+    jobs = context.socket(zmq.PULL)
+    jobs.bind(ecreceive.threads.ZMQ_JOB_SUBMIT_SOCKET)
+
+    main = ecreceive.threads.MainThread()
+    main.context = context
+    main.job_submit_socket = context.socket(zmq.PUSH)
+    main.job_submit_socket.connect(ecreceive.threads.ZMQ_JOB_SUBMIT_SOCKET)
+    main.checkpoint_socket = req_socket(context, ecreceive.threads.ZMQ_CHECKPOINT_SOCKET)
+
+    assert main.process_incomplete_checkpoints([]) == keys
+    submitted = []
+    while jobs.poll(100):
+        submitted += jobs.recv_multipart()
+    assert submitted == [key.encode() for key in keys]
+
+
+def test_worker_skips_processed_dataset(context, killswitch, tmp_path, monkeypatch):
+    """
+    Test that a dataset submitted again is skipped, even when another worker
+    receives it, unless its md5sum file has been written again.
+    """
+    monkeypatch.setattr(ecreceive.threads, 'DONE_CACHE', collections.OrderedDict())
+    process_file = Mock(return_value=True)
+    monkeypatch.setattr(ecreceive.dataset.DatasetPublisher, 'process_file', process_file)
+    lookups = []
+
+    def is_done(signature, is_done=ecreceive.threads.is_done):
+        done = is_done(signature)
+        lookups.append((threading.current_thread().name, done))
+        return done
+    monkeypatch.setattr(ecreceive.threads, 'is_done', is_done)
+
+    (tmp_path / 'F0').write_bytes(b'test\n')
+    (tmp_path / 'F0.md5').write_bytes(b'd8e8fca2dc0f896fd7cb4cb0031ba249')
+    kwargs = {
+        'productstatus_url': 'http://127.0.0.1:8000',
+        'productstatus_username': 'admin',
+        'productstatus_api_key': 'key',
+        'productstatus_verify_ssl': False,
+        'productstatus_service_backend': 'backend',
+        'productstatus_source': 'source',
+        'base_url': 'file:///',
+        'file_lifetime': 600,
+        'spool_directory': str(tmp_path),
+    }
+    ecreceive.threads.DistributionThread(context, killswitch).start()
+    workers = [ecreceive.threads.WorkerThread(context, killswitch, **kwargs) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    submit = context.socket(zmq.PUSH)
+    submit.connect(ecreceive.threads.ZMQ_JOB_SUBMIT_SOCKET)
+    # Let both workers ask for a job before the first one is submitted.
+    assert wait_for(lambda: all(hasattr(worker, 'publisher') for worker in workers))
+    time.sleep(0.1)
+
+    submit.send(b'F0.md5')
+    # Wait until the dataset is marked as processed, not just looked up.
+    assert wait_for(lambda: process_file.call_count == 1 and ecreceive.threads.DONE_CACHE)
+    # The worker that processed the dataset is now the most recently used,
+    # so the next job goes to the other one.
+    submit.send(b'F0.md5')
+    assert wait_for(lambda: len(lookups) == 2)
+    assert lookups[0][1] is False and lookups[1][1] is True
+    assert lookups[0][0] != lookups[1][0]
+    assert process_file.call_count == 1
+
+    # A dataset delivered again under the same name is processed again.
+    st = os.stat(tmp_path / 'F0.md5')
+    os.utime(tmp_path / 'F0.md5', ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    submit.send(b'F0.md5')
+    assert wait_for(lambda: process_file.call_count == 2)
+    assert not killswitch.is_set()
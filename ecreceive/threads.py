@@ -3,7 +3,8 @@ This module contains all threads run by the main program.
 """
 
 import os
-import glob
+import pickle
+import collections
 import logging
 import logging.config
 import datetime
@@ -12,41 +13,97 @@ import argparse
 import configparser
 import zmq
 import threading
-import inotify.adapters
 
 import ecreceive
 import ecreceive.dataset
+import ecreceive.inotify
 import ecreceive.checkpoint
 
 import productstatus.api
 
 
-# Listen for kill signals from other threads
-ZMQ_KILL_SOCKET = 'tcp://127.0.0.1:9960'
+# All threads share a single ZeroMQ context, and talk to each other over
+# in-process transports. Endpoints must be bound before they are connected to.
 # Pool of threads
-ZMQ_WORKERS_SOCKET = 'tcp://127.0.0.1:9970'
+ZMQ_WORKERS_SOCKET = 'inproc://workers'
 # Where to submit jobs to the thread pool
-ZMQ_JOB_SUBMIT_SOCKET = 'tcp://127.0.0.1:9980'
+ZMQ_JOB_SUBMIT_SOCKET = 'inproc://jobs'
 # Where to send log file messages
-ZMQ_CHECKPOINT_SOCKET = 'tcp://127.0.0.1:9990'
-# How many seconds to wait for running threads to complete
-THREAD_GRACE = 0
+ZMQ_CHECKPOINT_SOCKET = 'inproc://checkpoint'
+# How many messages each socket may queue, unless set in the configuration file
+ZMQ_HWM = 10000
+# Maximum number of jobs submitted in a single message on startup
+JOB_BATCH_SIZE = 256
+# Sent by worker threads when they are ready to process another job
+WORKER_READY = b'READY'
+# Maximum number of checkpointed files read in a single request on startup
+CHECKPOINT_KEYS_PAGE_SIZE = 1024
+# Maximum number of queued checkpoint requests to commit in one transaction
+CHECKPOINT_BATCH_SIZE = 64
+
+# Stat signatures of the md5sum files of datasets processed by any worker
+# thread, least recently used first. The distribution thread hands a dataset
+# submitted again to whichever worker is idle, usually not the one that
+# processed it, so a per-worker cache would rarely hit. It is module-level
+# because the workers share nothing else in memory: they are created with the
+# same configuration keyword arguments and talk to each other over ZeroMQ.
+DONE_CACHE = collections.OrderedDict()
+DONE_CACHE_SIZE = 10000
+DONE_CACHE_LOCK = threading.Lock()
+
+
+def md5_file_signature(spool_directory, filename):
+    """
+    Return the stat signature of the md5sum file of the dataset 'filename'
+    in the spool directory, or None if it does not exist. The signature
+    changes if the dataset is delivered again under the same name.
+    """
+    if not filename.endswith('.md5'):
+        filename += '.md5'
+    try:
+        return ecreceive.dataset.stat_signature(os.stat(os.path.join(spool_directory, filename)))
+    except OSError:
+        return None
+
+
+def is_done(signature):
+    """
+    Return True if the dataset with the given md5sum file stat signature has
+    already been processed.
+    """
+    with DONE_CACHE_LOCK:
+        if signature not in DONE_CACHE:
+            return False
+        DONE_CACHE.move_to_end(signature)
+        return True
+
+
+def set_done(signature):
+    """
+    Remember that the dataset with the given md5sum file stat signature has
+    been processed.
+    """
+    with DONE_CACHE_LOCK:
+        DONE_CACHE[signature] = True
+        DONE_CACHE.move_to_end(signature)
+        while len(DONE_CACHE) > DONE_CACHE_SIZE:
+            DONE_CACHE.popitem(last=False)
 
 
 class ZMQThread(threading.Thread):
     """
     Base class for all threads. It provides communication with the main thread,
     enabling the thread to kill the program when an unhandled exception occurs.
+    The main thread waits for the 'killswitch' event to be set.
     """
 
-    def setup_zmq(self):
-        self.context = zmq.Context()
-        self.killswitch = self.context.socket(zmq.PUSH)
-        self.killswitch.connect(ZMQ_KILL_SOCKET)
+    def setup_zmq(self, context, killswitch):
+        self.context = context
+        self.killswitch = killswitch
 
     def kill_main_thread(self):
         logging.info("The thread crashed! I'm bringing down the entire application!")
-        self.killswitch.send_string('KILL')
+        self.killswitch.set()
 
     def run(self):
         ecreceive.run_with_exception_logging(self.run_inner)
@@ -57,28 +114,54 @@ class CheckpointThread(ZMQThread):
     """
     This thread is responsible for read and write operations from/to the
     checkpoint file. All operations are handled serially, making the file
-    operation thread safe.
+    operation thread safe. Requests that arrive while a transaction is being
+    committed are committed together in the next one.
     """
-    def __init__(self, checkpoint_file):
+    def __init__(self, context, killswitch, checkpoint_file):
         threading.Thread.__init__(self)
         self.daemon = True
         self.name = 'CheckpointThread'
         self.checkpoint_file = checkpoint_file
         self.checkpoint = ecreceive.checkpoint.Checkpoint(self.checkpoint_file)
-        self.setup_zmq()
-        self.socket = self.context.socket(zmq.REP)
+        self.setup_zmq(context, killswitch)
+        # A ROUTER socket lets us receive requests from several workers
+        # before replying to any of them.
+        self.socket = self.context.socket(zmq.ROUTER)
+        # Fail loudly instead of silently dropping replies that cannot be
+        # delivered; the worker waiting for it would otherwise hang.
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.socket.bind(ZMQ_CHECKPOINT_SOCKET)
 
+    def recv_requests(self):
+        """
+        Wait for a request, and return it along with any other requests that
+        are already queued, as a list of [identity, delimiter, payload]
+        messages.
+        """
+        requests = [self.socket.recv_multipart()]
+        while len(requests) < CHECKPOINT_BATCH_SIZE:
+            try:
+                requests.append(self.socket.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return requests
+
     def run_inner(self):
         logging.info('Checkpoint thread started on %s' % ZMQ_CHECKPOINT_SOCKET)
         self.checkpoint.unlock_all()
         logging.info('All transactions unlocked.')
         while True:
-            request = self.socket.recv_json()
-            logging.info('Received checkpoint request: %s' % request)
-            func = getattr(self.checkpoint, request[0])
-            rc = func(*request[1:])
-            self.socket.send_json(rc)
+            replies = []
+            with self.checkpoint.batch():
+                for identity, delimiter, payload in self.recv_requests():
+                    request = pickle.loads(payload)
+                    logging.info('Received checkpoint request: %s', request)
+                    func = getattr(self.checkpoint, request[0])
+                    rc = func(*request[1:])
+                    replies.append([identity, delimiter, pickle.dumps(rc)])
+            # Only reply once the changes are committed.
+            for reply in replies:
+                self.socket.send_multipart(reply)
 
 
 class DirectoryWatcherThread(ZMQThread):
@@ -86,41 +169,55 @@ class DirectoryWatcherThread(ZMQThread):
     This thread runs inotify on the spool directory, emitting a message each
     time an event is received.
     """
-    def __init__(self, spool_directory):
+    def __init__(self, context, killswitch, spool_directory):
         threading.Thread.__init__(self)
         self.daemon = True
         self.name = 'DirectoryWatcherThread'
-        self.setup_zmq()
-        self.socket = self.context.socket(zmq.PUSH)
-        self.socket.connect(ZMQ_JOB_SUBMIT_SOCKET)
+        self.setup_zmq(context, killswitch)
         self.spool_directory = spool_directory
         try:
-            self.inotify = inotify.adapters.Inotify()
-            self.inotify.add_watch(self.spool_directory.encode('ascii'))
-        except:
+            self.inotify = ecreceive.inotify.Inotify()
+            # Files appear in the spool directory either by being written
+            # there, or by being renamed into place.
+            self.inotify.add_watch(self.spool_directory,
+                                   ecreceive.inotify.IN_CLOSE_WRITE | ecreceive.inotify.IN_MOVED_TO)
+        except OSError:
             raise ecreceive.exceptions.ECReceiveException('Something went wrong when setting up the inotify watch for %s. Does the directory exist, and do you have correct permissions?' % self.spool_directory)
 
     def process_inotify_event(self, event):
         """
-        Perform an action when an inotify event is received.
+        Return the name of the file to process for an inotify event, or None
+        if there is nothing to process. The kernel only reports the events we
+        are watching for, and queue overflows.
         """
-        if event is None:
-            return
-        header, attribs, path, filename = event
-        if 'IN_CLOSE_WRITE' not in attribs:
-            return
-        logging.info('Filesystem has IN_CLOSE_WRITE event for %s' % filename)
+        wd, mask, cookie, filename = event
+        if mask & ecreceive.inotify.IN_Q_OVERFLOW:
+            logging.error('Inotify event queue overflowed; events have been lost.')
+            return None
+        logging.info('Filesystem has a new file: %s' % filename)
         if not filename.endswith(b'.md5'):
             logging.info('Ignoring non-md5sum input file.')
-            return
-        self.socket.send_string(filename.decode('utf-8'))
+            return None
+        return filename
 
     def run_inner(self):
         """
-        Iterate over inotify file events from the kernel.
+        Iterate over inotify file events from the kernel, submitting all
+        files from each read as a single message.
         """
-        for event in self.inotify.event_gen():
-            self.process_inotify_event(event)
+        # Create the socket in the thread that uses it.
+        self.socket = self.context.socket(zmq.PUSH)
+        self.socket.connect(ZMQ_JOB_SUBMIT_SOCKET)
+        while True:
+            filenames = []
+            for event in self.inotify.read_events():
+                filename = self.process_inotify_event(event)
+                if filename is not None:
+                    filenames.append(filename)
+            # Pass the raw file names on; workers decode them when they
+            # receive them.
+            if filenames:
+                self.socket.send_multipart(filenames)
 
 
 class WorkerThread(ZMQThread):
@@ -129,12 +226,30 @@ class WorkerThread(ZMQThread):
     communication. The number of started threads is defined in the
     configuration file.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, context, killswitch, **kwargs):
         threading.Thread.__init__(self)
         self.daemon = True
+        self.kwargs = kwargs
+
+        self.setup_zmq(context, killswitch)
 
-        self.setup_zmq()
-        self.socket = self.context.socket(zmq.PULL)
+        # Productstatus client
+        self.productstatus_api = productstatus.api.Api(
+            kwargs['productstatus_url'],
+            username=kwargs['productstatus_username'],
+            api_key=kwargs['productstatus_api_key'],
+            verify_ssl=kwargs['productstatus_verify_ssl'],
+        )
+
+    def setup_sockets(self):
+        """
+        Create the sockets used by this thread, and the dataset publisher
+        using them. Must be called from the thread itself, since ZeroMQ
+        sockets should not be shared between threads.
+        """
+        # Jobs are requested from the distribution thread whenever this
+        # thread is idle.
+        self.socket = self.context.socket(zmq.REQ)
         self.socket.connect(ZMQ_WORKERS_SOCKET)
 
         # Communication with the Checkpoint writer
@@ -145,32 +260,31 @@ class WorkerThread(ZMQThread):
         self.resubmit_socket = self.context.socket(zmq.PUSH)
         self.resubmit_socket.connect(ZMQ_JOB_SUBMIT_SOCKET)
 
-        # Productstatus client
-        self.productstatus_api = productstatus.api.Api(
-            kwargs['productstatus_url'],
-            username=kwargs['productstatus_username'],
-            api_key=kwargs['productstatus_api_key'],
-            verify_ssl=kwargs['productstatus_verify_ssl'],
-        )
-
         # Dataset processing and publishing
         self.publisher = ecreceive.dataset.DatasetPublisher(
             self.checkpoint_socket,
-            kwargs['base_url'],
-            kwargs['file_lifetime'],
-            kwargs['productstatus_service_backend'],
-            kwargs['productstatus_source'],
-            kwargs['spool_directory'],
+            self.kwargs['base_url'],
+            self.kwargs['file_lifetime'],
+            self.kwargs['productstatus_service_backend'],
+            self.kwargs['productstatus_source'],
+            self.kwargs['spool_directory'],
             self.productstatus_api,
         )
 
     def run_inner(self):
+        self.setup_sockets()
         logging.info('Worker thread started')
         while True:
+            self.socket.send(WORKER_READY)
             request = self.socket.recv_string()
             logging.info('Received processing request: %s' % request)
+            signature = md5_file_signature(self.kwargs['spool_directory'], request)
+            if signature is not None and is_done(signature):
+                logging.info('Dataset %s has already been processed; skipping' % request)
+                continue
             try:
-                self.publisher.process_file(request)
+                if self.publisher.process_file(request) and signature is not None:
+                    set_done(signature)
             except ecreceive.exceptions.TryAgainException:
                 logging.error('Processing of %s was disrupted; resubmitting to queue' % request)
                 self.resubmit_socket.send_string(request)
@@ -179,14 +293,19 @@ class WorkerThread(ZMQThread):
 class DistributionThread(ZMQThread):
     """
     This thread shall load balance job processing requests among a collection of threads.
+    Each job is handed to the worker that has been idle for the longest time,
+    so that a slow job never holds up jobs queued behind it.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, context, killswitch):
         threading.Thread.__init__(self)
         self.name = 'DistributionThread'
         self.daemon = True
 
-        self.setup_zmq()
-        self.workers = self.context.socket(zmq.PUSH)
+        self.setup_zmq(context, killswitch)
+        self.workers = self.context.socket(zmq.ROUTER)
+        # Fail loudly instead of silently dropping jobs that cannot be
+        # delivered to a worker.
+        self.workers.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.workers.bind(ZMQ_WORKERS_SOCKET)
         self.clients = self.context.socket(zmq.PULL)
         self.clients.bind(ZMQ_JOB_SUBMIT_SOCKET)
@@ -195,7 +314,32 @@ class DistributionThread(ZMQThread):
         logging.info('Process submission socket listening on %s' % ZMQ_JOB_SUBMIT_SOCKET)
         logging.info('Process distribution socket listening on %s' % ZMQ_WORKERS_SOCKET)
         logging.info('Now distributing processing requests.')
-        zmq.proxy(self.clients, self.workers)
+        # Identities of idle workers, least recently used first.
+        available = collections.deque()
+        # Jobs received but not yet handed to a worker. Each frame of a
+        # submitted message is a separate job.
+        jobs = collections.deque()
+        poller = zmq.Poller()
+        poller.register(self.workers, zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            # Handle everything that is queued on each wakeup, instead of
+            # polling again for every message.
+            try:
+                while self.workers in events:
+                    identity, delimiter, ready = self.workers.recv_multipart(zmq.NOBLOCK)
+                    available.append(identity)
+            except zmq.Again:
+                pass
+            try:
+                while self.clients in events and len(jobs) < len(available):
+                    jobs.extend(self.clients.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                pass
+            while jobs and available:
+                self.workers.send_multipart([available.popleft(), b'', jobs.popleft()])
+            # Only accept jobs while there is a worker to give them to.
+            poller.register(self.clients, zmq.POLLIN if available else 0)
 
 
 class MainThread(object):
@@ -207,36 +351,58 @@ class MainThread(object):
 
     def __init__(self):
         self.threads = []
-        self.context = zmq.Context()
-        self.job_submit_socket = self.context.socket(zmq.PUSH)
-        self.job_submit_socket.connect(ZMQ_JOB_SUBMIT_SOCKET)
-        self.checkpoint_socket = self.context.socket(zmq.REQ)
-        self.checkpoint_socket.connect(ZMQ_CHECKPOINT_SOCKET)
+        self.context = zmq.Context.instance()
+        # Set by threads that crash.
+        self.killswitch = threading.Event()
+
+    def submit_jobs(self, filenames):
+        """
+        Submit processing requests for a list of files, in messages of up to
+        JOB_BATCH_SIZE files each.
+        """
+        for i in range(0, len(filenames), JOB_BATCH_SIZE):
+            self.job_submit_socket.send_multipart([f.encode() for f in filenames[i:i + JOB_BATCH_SIZE]])
 
-    def process_directory(self, directory):
+    def process_directory(self, directory, checkpointed_files=frozenset()):
         """
-        Process all files in a directory.
+        Process all files in a directory, except datasets whose data file
+        name is in 'checkpointed_files', since they have already been
+        submitted.
         """
-        files = list(glob.iglob(os.path.join(directory, '*.md5')))
+        # Like glob, skip hidden files. is_file() is answered from the
+        # directory listing for anything but symlinks.
+        with os.scandir(directory) as entries:
+            files = [entry.name for entry in entries
+                     if entry.name.endswith('.md5') and not entry.name.startswith('.')
+                     and entry.name[:-4] not in checkpointed_files and entry.is_file()]
         logging.info('Processing %d datasets in directory %s.' % (len(files), directory))
         for f in files:
-            f = os.path.basename(f)
             logging.info('Sending process request for dataset: %s' % f)
-            self.job_submit_socket.send_string(f)
+        self.submit_jobs(files)
         logging.info('Finished processing %s.' % directory)
 
     def process_incomplete_checkpoints(self, directories):
         """
         Iterates through files left unprocessed, and does away with them.
+        Returns the names of the files that were submitted.
         """
-        self.checkpoint_socket.send_json(['keys'])
-        checkpointed_files = list(self.checkpoint_socket.recv_json())
-        n_checkpointed = len(checkpointed_files)
-        logging.info('Processing %d incomplete checkpoints.' % n_checkpointed)
-        for f in checkpointed_files:
-            logging.info('Sending process request for unfinished dataset: %s' % f)
-            self.job_submit_socket.send_string(f)
-        logging.info('Finished processing incomplete checkpoints.')
+        logging.info('Processing incomplete checkpoints.')
+        checkpointed_files = []
+        after = ''
+        # Read the checkpointed files a page at a time, submitting each page
+        # before requesting the next.
+        while True:
+            self.checkpoint_socket.send_pyobj(('keys', after, CHECKPOINT_KEYS_PAGE_SIZE))
+            page = self.checkpoint_socket.recv_pyobj()
+            for f in page:
+                logging.info('Sending process request for unfinished dataset: %s' % f)
+            self.submit_jobs(page)
+            checkpointed_files += page
+            if len(page) < CHECKPOINT_KEYS_PAGE_SIZE:
+                break
+            after = page[-1]
+        logging.info('Finished processing %d incomplete checkpoints.' % len(checkpointed_files))
+        return checkpointed_files
 
     def setup_configuration(self):
         self.argument_parser = argparse.ArgumentParser()
@@ -246,14 +412,15 @@ class MainThread(object):
         # Parse command-line arguments.
         self.args = self.argument_parser.parse_args()
 
-        # Configure logging.
-        logging.config.fileConfig(self.args.config)
+        # Read configuration file.
+        self.config_parser = configparser.ConfigParser()
+        with open(self.args.config) as config_file:
+            self.config_parser.read_file(config_file)
 
-        logging.info('Starting up ECMWF dissemination receiver.')
+        # Configure logging from the already parsed configuration file.
+        logging.config.fileConfig(self.config_parser)
 
-        # Read configuration file.
-        self.config_parser = configparser.SafeConfigParser()
-        self.config_parser.read(self.args.config)
+        logging.info('Starting up ECMWF dissemination receiver.')
 
         # Collect parameters for the worker threads.
         self.kwargs = {
@@ -268,46 +435,58 @@ class MainThread(object):
             'spool_directory': self.config_parser.get('ecreceive', 'spool_directory'),
         }
 
+        # Let bursts of incoming files queue up in the sockets instead of
+        # blocking the directory watcher. Applies to all sockets created
+        # from now on.
+        hwm = self.config_parser.getint('ecreceive', 'zmq_hwm', fallback=ZMQ_HWM)
+        self.context.setsockopt(zmq.SNDHWM, hwm)
+        self.context.setsockopt(zmq.RCVHWM, hwm)
+
     def main(self):
 
-        # Set up processing threads.
-        num_threads = self.config_parser.getint('ecreceive', 'worker_threads')
-        for i in range(num_threads):
-            thread = WorkerThread(**self.kwargs)
-            thread.start()
-            self.threads += [thread]
+        # Threads that bind sockets are set up before the threads that
+        # connect to them.
 
         # Set up the checkpoint writer thread.
         checkpoint_file = self.config_parser.get('ecreceive', 'checkpoint_file')
-        checkpoint_thread = CheckpointThread(checkpoint_file)
+        checkpoint_thread = CheckpointThread(self.context, self.killswitch, checkpoint_file)
         checkpoint_thread.start()
         self.threads += [checkpoint_thread]
 
-        # Set up the inotify thread.
-        inotify_thread = DirectoryWatcherThread(self.kwargs['spool_directory'])
-        inotify_thread.start()
-        self.threads += [inotify_thread]
-
         # Set up the process distribution thread.
-        distribution_thread = DistributionThread()
+        distribution_thread = DistributionThread(self.context, self.killswitch)
         distribution_thread.start()
         self.threads += [distribution_thread]
 
-        # Listen for kill signals from threads.
-        killswitch = self.context.socket(zmq.PULL)
-        killswitch.bind(ZMQ_KILL_SOCKET)
+        # Set up processing threads.
+        num_threads = self.config_parser.getint('ecreceive', 'worker_threads')
+        for i in range(num_threads):
+            thread = WorkerThread(self.context, self.killswitch, **self.kwargs)
+            thread.start()
+            self.threads += [thread]
+
+        # Set up the inotify thread.
+        inotify_thread = DirectoryWatcherThread(self.context, self.killswitch, self.kwargs['spool_directory'])
+        inotify_thread.start()
+        self.threads += [inotify_thread]
+
+        # Sockets for submitting jobs and reading checkpoints.
+        self.job_submit_socket = self.context.socket(zmq.PUSH)
+        self.job_submit_socket.connect(ZMQ_JOB_SUBMIT_SOCKET)
+        self.checkpoint_socket = self.context.socket(zmq.REQ)
+        self.checkpoint_socket.connect(ZMQ_CHECKPOINT_SOCKET)
 
         # Run unfinished processing
-        self.process_incomplete_checkpoints([
+        checkpointed_files = self.process_incomplete_checkpoints([
             self.kwargs['spool_directory'],
         ])
-        self.process_directory(self.kwargs['spool_directory'])
+        self.process_directory(self.kwargs['spool_directory'], set(checkpointed_files))
 
-        # The program is now running until a signal is received on
-        # ZMQ_KILL_SOCKET, or an exception is triggered.
+        # The program is now running until a thread sets the killswitch,
+        # or an exception is triggered.
         try:
             logging.info('ECMWF dissemination receiver daemon ready.')
-            killswitch.recv_string()
+            self.killswitch.wait()
         except KeyboardInterrupt:
             pass
 
@@ -319,11 +498,11 @@ class MainThread(object):
         # Catch and log all exceptions
         rc = ecreceive.run_with_exception_logging(self.main)
 
-        # Kill threads
-        logging.info('Received shutdown signal, waiting %d seconds for each thread to complete...' % THREAD_GRACE)
-        for thread in self.threads:
-            logging.info('Killing thread: %s' % thread.name)
-            thread.join(THREAD_GRACE)
+        # All threads are daemon threads. They are neither joined nor
+        # signalled; they end abruptly when the process exits. The context is
+        # not destroyed here, since that would close sockets that are still in
+        # use by the other threads.
+        logging.info('Received shutdown signal; %d daemon threads will end with the process.' % len(self.threads))
 
         logging.info('ECMWF dissemination receiver daemon terminating.')
 